@@ -1,4 +1,3 @@
-import os
 import re
 
 import bpy
@@ -66,19 +65,27 @@ class BlendLoader(LoaderInterface):
             if load_from in self.known_datablock_names.keys():
                 # if some regex was specified, get corresponding matching entity's names
                 if entities is not None:
-                    entities_to_load = [item for item in getattr(data_from, self.known_datablock_names[load_from])
-                                        if re.fullmatch(entities, item) is not None]
+                    pattern = re.compile(entities)
+                    entities_to_load = list(filter(pattern.fullmatch,
+                                                   getattr(data_from, self.known_datablock_names[load_from])))
                 # get all entity's names if not
                 else:
                     entities_to_load = getattr(data_from, self.known_datablock_names[load_from])
-                # load entities
-                for entity_to_load in entities_to_load:
-                    bpy.ops.wm.append(filepath=os.path.join(path, load_from, entity_to_load),
-                                      filename=entity_to_load,
-                                      directory=os.path.join(path + load_from))
+                # load all entities at once when leaving the context
+                setattr(data_to, self.known_datablock_names[load_from], entities_to_load)
             else:
                 raise Exception("Unsupported datablock/folder name: " + load_from +
                                 "\nSupported names: " + str(self.known_datablock_names.keys()) +
                                 "\nIf your ID exists, but not supported, please append a new pair of "
                                 "{type ID(folder name): parameter name} to the 'known_datablock_names' dict. Use this "
                                 "for finding your parameter name: " + str(dir(data_from)))
+
+        # link the loaded objects and collections to the scene, as bpy.ops.wm.append would do
+        if load_from == "/Object":
+            for obj in data_to.objects:
+                if obj is not None:
+                    bpy.context.collection.objects.link(obj)
+        elif load_from == "/Collection":
+            for collection in data_to.collections:
+                if collection is not None:
+                    bpy.context.scene.collection.children.link(collection)
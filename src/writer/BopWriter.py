@@ -1,35 +1,39 @@
-import json
 import os
-import math
 import glob
+import cv2
 import numpy as np
-import png
+import orjson
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import bpy
-from mathutils import Euler, Matrix, Vector
 
 from src.utility.BlenderUtility import get_all_mesh_objects, load_image
 from src.utility.Utility import Utility
 from src.writer.WriterInterface import WriterInterface
 
+# Low compression, the smooth depth images hardly compress better with stronger settings.
+DEPTH_PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_DEFAULT]
+# Disabling the PNG row filters is optional: the flag only exists since OpenCV 4.11, older versions (e.g. the
+# pinned 4.2 of the BOP examples) keep libpng's default filters.
+if hasattr(cv2, "IMWRITE_PNG_FILTER"):
+    DEPTH_PNG_PARAMS += [cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE]
+
 
 def load_json(path, keys_to_int=False):
     """Loads content of a JSON file.
     From the BOP toolkit (https://github.com/thodan/bop_toolkit).
 
     :param path: Path to the JSON file.
+    :param keys_to_int: Whether to convert the numeric top-level keys to integers.
     :return: Content of the loaded JSON file.
     """
-    # Keys to integers.
-    def convert_keys_to_int(x):
-        return {int(k) if k.lstrip('-').isdigit() else k: v for k, v in x.items()}
+    with open(path, 'rb') as f:
+        content = orjson.loads(f.read())
 
-    with open(path, 'r') as f:
-        if keys_to_int:
-            content = json.load(f, object_hook=lambda x: convert_keys_to_int(x))
-        else:
-            content = json.load(f)
+    # Keys to integers.
+    if keys_to_int and isinstance(content, dict):
+        content = {int(k) if k.lstrip('-').isdigit() else k: v for k, v in content.items()}
 
     return content
 
@@ -38,52 +42,59 @@ def save_json(path, content):
     """ Saves the content to a JSON file in a human-friendly format.
     From the BOP toolkit (https://github.com/thodan/bop_toolkit).
 
+    The values are serialized with orjson, numpy arrays are written as lists. Only the top-level keys are sorted,
+    nested dictionaries are written in insertion order. Unlike the BOP toolkit, which uses json.dumps, the values
+    are written compactly without spaces after separators (e.g. [1.0,2.0]) and floats use orjson's spelling
+    (e.g. 1e-5 instead of 1e-05). The files are still valid JSON.
+
     :param path: Path to the output JSON file.
     :param content: Dictionary/list to save.
     """
-    with open(path, 'w') as f:
-
-        if isinstance(content, dict):
-            f.write('{\n')
-            content_sorted = sorted(content.items(), key=lambda x: x[0])
-            for elem_id, (k, v) in enumerate(content_sorted):
-                f.write(
-                    '  \"{}\": {}'.format(k, json.dumps(v, sort_keys=True)))
-                if elem_id != len(content) - 1:
-                    f.write(',')
-                f.write('\n')
-            f.write('}')
-
-        elif isinstance(content, list):
-            f.write('[\n')
-            for elem_id, elem in enumerate(content):
-                f.write('  {}'.format(json.dumps(elem, sort_keys=True)))
-                if elem_id != len(content) - 1:
-                    f.write(',')
-                f.write('\n')
-            f.write(']')
-
-        else:
-            json.dump(content, f, sort_keys=True)
-
-
-def save_depth(path, im):
+    dump_options = orjson.OPT_SERIALIZE_NUMPY
+
+    # Assemble the whole file in memory, so it is written with a single call.
+    if isinstance(content, dict):
+        lines = [b'  "' + str(k).encode() + b'": ' + orjson.dumps(content[k], option=dump_options)
+                 for k in sorted(content)]
+        data = b'{\n' + b',\n'.join(lines) + (b'\n' if lines else b'') + b'}'
+
+    elif isinstance(content, list):
+        lines = [b'  ' + orjson.dumps(elem, option=dump_options) for elem in content]
+        data = b'[\n' + b',\n'.join(lines) + (b'\n' if lines else b'') + b']'
+
+    else:
+        data = orjson.dumps(content, option=dump_options | orjson.OPT_SORT_KEYS)
+
+    # A single large write bypasses the file buffer, so no larger buffer size is needed for big chunk files.
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def save_depth(path, im, im_uint16=None):
     """Saves a depth image (16-bit) to a PNG file.
     From the BOP toolkit (https://github.com/thodan/bop_toolkit).
 
     :param path: Path to the output depth image file.
     :param im: ndarray with the depth image to save.
+    :param im_uint16: Optional uint16 ndarray with the same shape as im, which is reused as conversion buffer.
     """
     if not path.endswith(".png"):
         raise ValueError('Only PNG format is currently supported.')
 
-    im[im > 65535] = 65535
-    im_uint16 = np.round(im).astype(np.uint16)
+    if im_uint16 is None:
+        im_uint16 = np.empty(im.shape, dtype=np.uint16)
+    elif im_uint16.shape != im.shape or im_uint16.dtype != np.uint16:
+        raise ValueError('The conversion buffer does not match the depth image: {} {}'.format(im_uint16.shape,
+                                                                                              im_uint16.dtype))
 
-    # PyPNG library can save 16-bit PNG and is faster than imageio.imwrite().
-    w_depth = png.Writer(im.shape[1], im.shape[0], greyscale=True, bitdepth=16)
-    with open(path, 'wb') as f:
-        w_depth.write(f, np.reshape(im_uint16, (-1, im.shape[1])))
+    # Clamp and round in-place and cast into the buffer to avoid temporary copies.
+    np.clip(im, 0, 65535, out=im)
+    np.rint(im, out=im)
+    np.copyto(im_uint16, im, casting='unsafe')
+
+    # Encode with libpng at a low compression level, the pure-Python PyPNG writer is a bottleneck for large images.
+    if not cv2.imwrite(path, im_uint16, DEPTH_PNG_PARAMS):
+        raise Exception("Could not write the depth image: {}".format(path))
 
 
 class BopWriter(WriterInterface):
@@ -102,11 +113,19 @@ class BopWriter(WriterInterface):
                                     "Type: bool. Default: False"
         "ignore_dist_thres", "Distance in meters between camera and object after which it is ignored. Mostly due to"
                              "failed physics. Type: float. Default: 5."
+
+    The poses are always written in the blender world frame, as read from the objects' matrix_world. The
+    "destination_frame" option of the WriterInterface is therefore not supported and must not be changed.
     """
 
     def __init__(self, config):
         WriterInterface.__init__(self, config)
 
+        # The poses are taken from matrix_world, which cannot be remapped to another coordinate frame.
+        if [axis.upper() for axis in self.destination_frame] != ["X", "Y", "Z"]:
+            raise Exception("The BopWriter does not support the destination_frame option: {}".format(
+                self.destination_frame))
+
         # Parse configuration.
         self.dataset = self.config.get_string("dataset")
 
@@ -121,6 +140,10 @@ class BopWriter(WriterInterface):
         # Multiply the output depth image with this factor to get depth in mm.
         self.depth_scale = 0.1
 
+        # Reusable uint16 conversion buffers for the depth images. Two are needed, as the depth image of the
+        # previous frame might still be written while the current one is converted.
+        self._depth_scratch = [None, None]
+
         # Format of the depth images.
         depth_ext = '.png'
 
@@ -209,17 +232,21 @@ class BopWriter(WriterInterface):
 
         return super()._get_attribute(object, attribute_name)
 
-    def get_camK_from_blender_attributes(self, cam_pose):
+    def get_camK_from_blender_attributes(self, cam_pose, width=None, height=None):
         """ Constructs the camera matrix K.
 
         :param cam_pose: Camera info.
+        :param width: Width of the rendered images in pixels. Read from the scene if not given.
+        :param height: Height of the rendered images in pixels. Read from the scene if not given.
         :return: camera matrix K as 9x1 list.
         """
         shift_x = self._get_camera_attribute(cam_pose, 'shift_x')
         shift_y = self._get_camera_attribute(cam_pose, 'shift_y')
         syn_cam_K = self._get_camera_attribute(cam_pose, 'loaded_intrinsics')
-        width = bpy.context.scene.render.resolution_x
-        height = bpy.context.scene.render.resolution_y
+        if width is None:
+            width = bpy.context.scene.render.resolution_x
+        if height is None:
+            height = bpy.context.scene.render.resolution_y
 
         cam_K = [0.] * 9
         cam_K[-1] = 1
@@ -241,7 +268,7 @@ class BopWriter(WriterInterface):
         width = bpy.context.scene.render.resolution_x
         height = bpy.context.scene.render.resolution_y
 
-        cam_K = self.get_camK_from_blender_attributes(self.cam_pose)
+        cam_K = self.get_camK_from_blender_attributes(self.cam_pose, width, height)
         camera = {'cx': cam_K[2],
                   'cy': cam_K[5],
                   'depth_scale': self.depth_scale,
@@ -257,34 +284,35 @@ class BopWriter(WriterInterface):
     def _get_frame_gt(self):
         """ Returns GT annotations for the active camera.
 
+        The poses of all dataset objects are transformed into the camera frame at once with numpy.
+
         :return: A list of GT annotations.
         """
-        camera_rotation = self._get_camera_attribute(self.cam_pose, 'rotation_euler')
-        camera_translation = self._get_camera_attribute(self.cam_pose, 'location')
-        H_c2w = Matrix.Translation(Vector(camera_translation)) @ Euler(
-            camera_rotation, 'XYZ').to_matrix().to_4x4()
+        # Use the world transformations cached by blender, the scale is removed from their rotation part.
+        H_c2w = np.array(self.cam_pose[1].matrix_world)
+        H_m2w = np.array([obj.matrix_world for obj in self.dataset_objects])
+        R_c2w = H_c2w[:3, :3] / np.linalg.norm(H_c2w[:3, :3], axis=0)
+        R_m2w = H_m2w[:, :3, :3] / np.linalg.norm(H_m2w[:, :3, :3], axis=1)[:, np.newaxis, :]
+        t_c2w = H_c2w[:3, 3]
+        object_translations = H_m2w[:, :3, 3]
 
-        # Blender to opencv coordinates.
-        H_c2w_opencv = H_c2w @ Matrix.Rotation(math.radians(-180), 4, "X")
-
-        frame_gt = []
-        for idx, obj in enumerate(self.dataset_objects):
-            object_rotation = self._get_object_attribute(obj, 'rotation_euler')
-            object_translation = self._get_object_attribute(obj, 'location')
-            H_m2w = Matrix.Translation(Vector(object_translation)) @ Euler(
-                object_rotation, 'XYZ').to_matrix().to_4x4()
+        # Blender to opencv coordinates (rotation by 180 degrees around the x axis).
+        R_c2w_opencv = R_c2w * np.array([1., -1., -1.])
 
-            cam_H_m2c = (H_m2w.inverted() @ H_c2w_opencv).inverted()
+        # The inverse of the rigid camera transformation is applied analytically.
+        cam_R_m2c = np.matmul(R_c2w_opencv.T, R_m2w)
+        cam_t_m2c = np.matmul(object_translations - t_c2w, R_c2w_opencv) * 1000.
 
-            cam_R_m2c = cam_H_m2c.to_quaternion().to_matrix()
-            cam_R_m2c = list(cam_R_m2c[0]) + list(cam_R_m2c[1]) + list(cam_R_m2c[2])
-            cam_t_m2c = list(cam_H_m2c.to_translation() * 1000.)
+        # ignore examples that fell through the plane
+        is_valid = np.linalg.norm(cam_t_m2c, axis=1) <= self._ignore_dist_thres * 1000.
 
-            # ignore examples that fell through the plane
-            if not np.linalg.norm(cam_t_m2c) > self._ignore_dist_thres * 1000.:
+        # The rows are kept as numpy arrays, save_json serializes them directly.
+        frame_gt = []
+        for obj, R, t, valid in zip(self.dataset_objects, cam_R_m2c.reshape(-1, 9), cam_t_m2c, is_valid):
+            if valid:
                 frame_gt.append({
-                    'cam_R_m2c': cam_R_m2c,
-                    'cam_t_m2c': cam_t_m2c,
+                    'cam_R_m2c': R,
+                    'cam_t_m2c': t,
                     'obj_id': self._get_object_attribute(obj, 'id')
                 })
             else:
@@ -292,11 +320,14 @@ class BopWriter(WriterInterface):
 
         return frame_gt
 
-    def _get_frame_camera(self):
+    def _get_frame_camera(self, width, height):
         """ Returns camera parameters for the active camera.
+
+        :param width: Width of the rendered images in pixels.
+        :param height: Height of the rendered images in pixels.
         """
         return {
-            'cam_K': list(self.get_camK_from_blender_attributes(self.cam_pose)),
+            'cam_K': self.get_camK_from_blender_attributes(self.cam_pose, width, height),
             'depth_scale': self.depth_scale
         }
 
@@ -308,17 +339,21 @@ class BopWriter(WriterInterface):
         chunk_dirs = sorted(glob.glob(os.path.join(self.chunks_dir, '*')))
         chunk_dirs = [d for d in chunk_dirs if os.path.isdir(d)]
 
+        # Initialize structures for the GT annotations and camera info.
+        chunk_gt = {}
+        chunk_camera = {}
+
         # Get ID's of the last already existing chunk and frame.
         curr_chunk_id = 0
         curr_frame_id = 0
         if len(chunk_dirs):
-            last_chunk_dir = sorted(chunk_dirs)[-1]
+            last_chunk_dir = chunk_dirs[-1]
             last_chunk_gt_fpath = os.path.join(last_chunk_dir, 'scene_gt.json')
             chunk_gt = load_json(last_chunk_gt_fpath, keys_to_int=True)
 
             # Last chunk and frame ID's.
             last_chunk_id = int(os.path.basename(last_chunk_dir))
-            last_frame_id = int(sorted(chunk_gt.keys())[-1])
+            last_frame_id = int(max(chunk_gt.keys()))
 
             # Current chunk and frame ID's.
             curr_chunk_id = last_chunk_id
@@ -327,72 +362,96 @@ class BopWriter(WriterInterface):
                 curr_chunk_id += 1
                 curr_frame_id = 0
 
-        # Initialize structures for the GT annotations and camera info.
-        chunk_gt = {}
-        chunk_camera = {}
         if curr_frame_id != 0:
-            # Load GT and camera info of the chunk we are appending to.
-            chunk_gt = load_json(
-                self.chunk_gt_tpath.format(chunk_id=curr_chunk_id), keys_to_int=True)
+            # Reuse the already loaded GT and load the camera info of the chunk we are appending to.
             chunk_camera = load_json(
                 self.chunk_camera_tpath.format(chunk_id=curr_chunk_id), keys_to_int=True)
 
-        # Go through all frames.
-        num_new_frames = bpy.context.scene.frame_end - bpy.context.scene.frame_start
-        for frame_id in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end):
-            # Activate frame.
-            bpy.context.scene.frame_set(frame_id)
-
-            # Reset data structures and prepare folders for a new chunk.
-            if curr_frame_id == 0:
-                chunk_gt = {}
-                chunk_camera = {}
-                os.makedirs(os.path.dirname(
-                    self.rgb_tpath.format(chunk_id=curr_chunk_id, im_id=0, im_type='PNG')))
-                os.makedirs(os.path.dirname(
-                    self.depth_tpath.format(chunk_id=curr_chunk_id, im_id=0)))
-
-            # Get GT annotations and camera info for the current frame.
-            chunk_gt[curr_frame_id] = self._get_frame_gt()
-            chunk_camera[curr_frame_id] = self._get_frame_camera()
-
-            # Copy the resulting RGB image.
-            rgb_output = self._find_registered_output_by_key("colors")
-            if rgb_output is None:
-                raise Exception("RGB image has not been rendered.")
-            image_type = '.png' if rgb_output['path'].endswith('png') else '.jpg'
-            rgb_fpath = self.rgb_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id, im_type=image_type)
-            shutil.copyfile(rgb_output['path'] % frame_id, rgb_fpath)
-
-            # Load the resulting dist image.
-            dist_output = self._find_registered_output_by_key("distance")
-            if dist_output is None:
-                raise Exception("Distance image has not been rendered.")
-            depth, _, _ = self._load_and_postprocess(dist_output['path'] % frame_id, "distance")
-
-            # Scale the depth to retain a higher precision (the depth is saved
-            # as a 16-bit PNG image with range 0-65535).
-            depth_mm = 1000.0 * depth  # [m] -> [mm]
-            depth_mm_scaled = depth_mm / float(self.depth_scale)
-
-            # Save the scaled depth image.
-            depth_fpath = self.depth_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id)
-            save_depth(depth_fpath, depth_mm_scaled)
-
-            # Save the chunk info if we are at the end of a chunk or at the last new frame.
-            if ((curr_frame_id + 1) % self.frames_per_chunk == 0) or\
-                  (frame_id == num_new_frames - 1):
-
-                # Save GT annotations.
-                save_json(self.chunk_gt_tpath.format(chunk_id=curr_chunk_id), chunk_gt)
-
-                # Save camera info.
-                save_json(self.chunk_camera_tpath.format(chunk_id=curr_chunk_id), chunk_camera)
-
-                # Update ID's.
-                curr_chunk_id += 1
-                curr_frame_id = 0
-            else:
-                curr_frame_id += 1
+        # Go through all frames. The RGB copy and the depth encoding of a frame are done in the background
+        # while the next frame is processed.
+        scene = bpy.context.scene
+        last_new_frame_id = scene.frame_end - 1
+        pending_image_writes = []
+
+        rgb_output = self._find_registered_output_by_key("colors")
+        if rgb_output is None:
+            raise Exception("RGB image has not been rendered.")
+        image_type = '.png' if rgb_output['path'].endswith('png') else '.jpg'
+        dist_output = self._find_registered_output_by_key("distance")
+        if dist_output is None:
+            raise Exception("Distance image has not been rendered.")
+
+        # The resolution is the same for all frames, as stored in camera.json.
+        width, height = scene.render.resolution_x, scene.render.resolution_y
+
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+            for frame_id in range(scene.frame_start, scene.frame_end):
+                # Activate frame.
+                scene.frame_set(frame_id)
+
+                # Get the image folders of the current chunk.
+                if curr_frame_id == 0 or frame_id == scene.frame_start:
+                    rgb_dir = os.path.dirname(
+                        self.rgb_tpath.format(chunk_id=curr_chunk_id, im_id=0, im_type=image_type))
+                    depth_dir = os.path.dirname(
+                        self.depth_tpath.format(chunk_id=curr_chunk_id, im_id=0))
+
+                # Reset data structures and prepare folders for a new chunk.
+                if curr_frame_id == 0:
+                    chunk_gt = {}
+                    chunk_camera = {}
+                    os.makedirs(rgb_dir)
+                    os.makedirs(depth_dir)
+
+                # Get GT annotations and camera info for the current frame.
+                chunk_gt[curr_frame_id] = self._get_frame_gt()
+                chunk_camera[curr_frame_id] = self._get_frame_camera(width, height)
+
+                # Copy the resulting RGB image.
+                rgb_fpath = os.path.join(rgb_dir, '{:06d}{}'.format(curr_frame_id, image_type))
+                rgb_write = pool.submit(shutil.copyfile, rgb_output['path'] % frame_id, rgb_fpath)
+
+                # Load the resulting dist image.
+                depth, _, _ = self._load_and_postprocess(dist_output['path'] % frame_id, "distance")
+
+                # Scale the depth to retain a higher precision (the depth is saved
+                # as a 16-bit PNG image with range 0-65535).
+                depth_mm_scaled = depth * (1000.0 / float(self.depth_scale))  # [m] -> [mm] -> scaled
+
+                # Save the scaled depth image, alternating between the two conversion buffers.
+                depth_scratch = self._depth_scratch[frame_id % 2]
+                if depth_scratch is None or depth_scratch.shape != depth_mm_scaled.shape:
+                    depth_scratch = np.empty(depth_mm_scaled.shape, dtype=np.uint16)
+                    self._depth_scratch[frame_id % 2] = depth_scratch
+                depth_fpath = os.path.join(depth_dir, '{:06d}.png'.format(curr_frame_id))
+                depth_write = pool.submit(save_depth, depth_fpath, depth_mm_scaled, depth_scratch)
+
+                # Wait for the images of the previous frame, so at most two frames are held in memory.
+                for image_write in pending_image_writes:
+                    image_write.result()
+                pending_image_writes = [rgb_write, depth_write]
+
+                # Save the chunk info if we are at the end of a chunk or at the last new frame.
+                if ((curr_frame_id + 1) % self.frames_per_chunk == 0) or\
+                      (frame_id == last_new_frame_id):
+
+                    # Save GT annotations.
+                    save_json(self.chunk_gt_tpath.format(chunk_id=curr_chunk_id), chunk_gt)
+
+                    # Save camera info.
+                    save_json(self.chunk_camera_tpath.format(chunk_id=curr_chunk_id), chunk_camera)
+
+                    # Release the annotations of the finished chunk.
+                    chunk_gt = {}
+                    chunk_camera = {}
+
+                    # Update ID's.
+                    curr_chunk_id += 1
+                    curr_frame_id = 0
+                else:
+                    curr_frame_id += 1
+
+            for image_write in pending_image_writes:
+                image_write.result()
 
         return
@@ -117,7 +117,6 @@ class WriterInterface(Module):
         """
         data = self._load_file(Utility.resolve_path(file_path))
         data, new_key, new_version = self._apply_postprocessing(key, data, version)
-        print("Key: " + key + " - shape: " + str(data.shape) + " - dtype: " + str(data.dtype) + " - path: " + file_path)
         return data, new_key, new_version
 
     def _load_file(self, file_path):